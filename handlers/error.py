@@ -0,0 +1,14 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+from utils.shared_context import logger
+
+async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Logs exceptions raised by handlers and tells the user that something went wrong."""
+    error = context.error
+    logger.error("Error while handling an update", exc_info=error)
+
+    if isinstance(update, Update) and update.effective_chat:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"Sorry, an error occurred: {type(error).__name__} - {error}"
+        )
@@ -1,14 +1,120 @@
 import asyncio
-import io
-from PIL import Image
 from telegram import Update
-from telegram.ext import ContextTypes
+from telegram.error import TelegramError
+from telegram.ext import Application, ContextTypes
 from google.genai import types
 
-from utils.config import DEFAULT_TEMPERATURE, PREFIX_SYS
-from utils.shared_context import chat_contexts, chat_temperatures, logger
-from utils.gemini_setup import create_gemini_client, create_new_chat
-from utils.sending import send_safe_message
+from utils.retry import with_retry
+from utils.shared_context import logger
+from utils.sending import send_to_gemini_and_reply
+
+GEMINI_IMAGE_TILE = 768  # Gemini scales images to tiles of this many pixels, so bigger photos add only upload time
+MAX_CONCURRENT_DOWNLOADS = 8  # Parallel Telegram downloads per media group
+MEDIA_GROUP_QUIET_PERIOD = 0.5  # Seconds without a new image before an album is processed
+MEDIA_GROUP_MAX_WAIT = 2.0  # Seconds after the first image when an album is processed regardless
+MEDIA_GROUP_WORKERS = 4  # Albums waited on concurrently; replies run in their own tasks
+
+media_group_queue = asyncio.Queue()  # (chat_id, media_group_id) of albums waiting to be processed
+media_group_workers = []
+
+def pick_photo_size(photos):
+    """
+    Picks the smallest PhotoSize that still covers a Gemini tile on its short side,
+    or the largest one when none does. Telegram sorts the sizes ascending.
+    """
+    return next((photo for photo in photos if min(photo.width, photo.height) >= GEMINI_IMAGE_TILE), photos[-1])
+
+async def collect_media_group(context: ContextTypes.DEFAULT_TYPE, media_group_id):
+    """Waits for an album to finish arriving, then removes it from chat_data and returns it."""
+    loop = asyncio.get_running_loop()
+    media_groups = context.chat_data.get("media_groups", {})
+
+    # Wait until no new image has arrived for MEDIA_GROUP_QUIET_PERIOD seconds,
+    # but no longer than MEDIA_GROUP_MAX_WAIT after the first one
+    while True:
+        media_group = media_groups.get(media_group_id)
+        if not media_group:
+            return
+        deadline = min(
+            media_group["last_arrival"] + MEDIA_GROUP_QUIET_PERIOD,
+            media_group["first_arrival"] + MEDIA_GROUP_MAX_WAIT
+        )
+        wait = deadline - loop.time()
+        if wait <= 0:
+            break
+        await asyncio.sleep(wait)
+
+    return media_groups.pop(media_group_id, None)
+
+async def process_media_group(context: ContextTypes.DEFAULT_TYPE, chat_id, media_group):
+    """Sends all images of a collected album to Gemini at once."""
+    # Keying by file_unique_id drops duplicates if Telegram redelivers an update
+    best_photos = {photo.file_unique_id: photo for photo in media_group["photos"]}.values()
+
+    download_slots = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+    async def download_photo(photo):
+        async with download_slots:
+            file = await with_retry(lambda: context.bot.get_file(photo.file_id))
+            return bytes(await with_retry(file.download_as_bytearray))
+
+    # Fetch all photos of the group concurrently
+    image_list = await asyncio.gather(
+        *(download_photo(photo) for photo in best_photos)
+    )
+
+    caption = media_group["caption"] or ""
+    parts = [types.Part(text=caption)]
+
+    # Attach images as inline_data; Telegram already serves photos as JPEG
+    for image_bytes in image_list:
+        parts.append(
+            types.Part(
+                inline_data=types.Blob(mime_type="image/jpeg", data=image_bytes)
+            )
+        )
+
+    await send_to_gemini_and_reply(context, chat_id, parts)
+
+async def reply_to_media_group(context: ContextTypes.DEFAULT_TYPE, chat_id, media_group):
+    """Processes a collected album and reports failures to the chat."""
+    try:
+        await process_media_group(context, chat_id, media_group)
+    except Exception as e:
+        logger.exception("Error processing media group")
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=f"Sorry, an error occurred: {type(e).__name__} - {e}")
+        except TelegramError:
+            logger.exception("Could not report the media group error")
+
+async def media_group_worker(application: Application):
+    """
+    Waits for queued albums to finish arriving, then hands each one off to its own
+    task, so slow Gemini replies never hold up albums from other chats.
+    """
+    while True:
+        chat_id, media_group_id = await media_group_queue.get()
+        context = application.context_types.context(application, chat_id=chat_id)
+        try:
+            media_group = await collect_media_group(context, media_group_id)
+            if media_group:
+                application.create_task(reply_to_media_group(context, chat_id, media_group))
+        except Exception:
+            logger.exception("Error collecting media group")
+        finally:
+            media_group_queue.task_done()
+
+async def start_media_group_workers(application: Application):
+    """Starts the media group workers; used as the application's post_init hook."""
+    for _ in range(MEDIA_GROUP_WORKERS):
+        media_group_workers.append(asyncio.create_task(media_group_worker(application)))
+
+async def stop_media_group_workers(application: Application):
+    """Cancels the media group workers; used as the application's post_shutdown hook."""
+    for worker in media_group_workers:
+        worker.cancel()
+    await asyncio.gather(*media_group_workers, return_exceptions=True)
+    media_group_workers.clear()
 
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles incoming images (including media groups) and interacts with the Gemini API."""
@@ -17,120 +123,37 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     logger.info(f"Handling image message from chat_id: {chat_id}")
 
-    # Ensure chat_context exists
-    if chat_id not in chat_contexts:
-        client = create_gemini_client()
-        new_chat = create_new_chat(client, PREFIX_SYS)
-        chat_contexts[chat_id] = new_chat
-
-    temperature = chat_temperatures.get(chat_id, DEFAULT_TEMPERATURE)
-    config_with_temp = types.GenerateContentConfig(
-        response_modalities=["Text", "Image"],
-        temperature=temperature
-    )
-
-    # If the message is part of a media group, accumulate images
+    # If the message is part of a media group, accumulate images and queue the album once
     if media_group_id:
         if "media_groups" not in context.chat_data:
             context.chat_data["media_groups"] = {}
+        loop = asyncio.get_running_loop()
         if media_group_id not in context.chat_data["media_groups"]:
             context.chat_data["media_groups"][media_group_id] = {
                 "photos": [],
-                "caption": update.message.caption or ""
+                "caption": update.message.caption or "",
+                "first_arrival": loop.time()
             }
+            media_group_queue.put_nowait((chat_id, media_group_id))
 
-        context.chat_data["media_groups"][media_group_id]["photos"].append(update.message.photo)
+        # Keep only the size that will be uploaded, not every PhotoSize of the message
+        context.chat_data["media_groups"][media_group_id]["photos"].append(pick_photo_size(update.message.photo))
+        context.chat_data["media_groups"][media_group_id]["last_arrival"] = loop.time()
         if update.message.caption:
             context.chat_data["media_groups"][media_group_id]["caption"] = update.message.caption
-
-        if "job" not in context.chat_data["media_groups"][media_group_id]:
-            async def process_media_group(mgid):
-                await asyncio.sleep(1)  # Wait for all images to arrive
-                media_group = context.chat_data["media_groups"].pop(mgid, None)
-                if not media_group:
-                    return
-
-                all_photos = [photo for photos in media_group["photos"] for photo in photos]
-                unique_images = {}
-                for photo in all_photos:
-                    # Use file_id prefix to deduplicate
-                    key = photo.file_id[:-7]
-                    if key not in unique_images or photo.file_size > unique_images[key].file_size:
-                        unique_images[key] = photo
-
-                image_list = []
-                for photo in unique_images.values():
-                    file = await context.bot.get_file(photo.file_id)
-                    image_bytes = await file.download_as_bytearray()
-                    image_list.append(Image.open(io.BytesIO(image_bytes)))
-
-                caption = media_group["caption"] or ""
-                parts = [types.Part(text=caption)]
-
-                # Attach images as inline_data
-                for img in image_list:
-                    buf = io.BytesIO()
-                    img.save(buf, format="JPEG")
-                    buf.seek(0)
-                    parts.append(
-                        types.Part(
-                            inline_data=types.Blob(mime_type="image/jpeg", data=buf.getvalue())
-                        )
-                    )
-
-                response = chat_contexts[chat_id].send_message(message=parts, config=config_with_temp)
-                for part in response.candidates[0].content.parts:
-                    if part.text is not None:
-                        await send_safe_message(context, chat_id, part.text)
-                    elif part.inline_data is not None:
-                        response_image_stream = io.BytesIO(part.inline_data.data)
-                        try:
-                            await context.bot.send_photo(chat_id=chat_id, photo=response_image_stream)
-                        except Exception as e:
-                            logger.error("Error sending image", exc_info=e)
-                            await context.bot.send_message(chat_id=chat_id, text="Error sending the image.")
-                    else:
-                        logger.warning("Unexpected response part from Gemini.")
-                        await context.bot.send_message(chat_id=chat_id, text="Unexpected response from Gemini.")
-
-            context.chat_data["media_groups"][media_group_id]["job"] = asyncio.create_task(process_media_group(media_group_id))
         return
 
     # Process a single image normally
-    try:
-        photo = update.message.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
-        image_bytes = await file.download_as_bytearray()
-        img = Image.open(io.BytesIO(image_bytes))
+    photo = pick_photo_size(update.message.photo)
+    file = await with_retry(lambda: context.bot.get_file(photo.file_id))
+    image_bytes = await with_retry(file.download_as_bytearray)
 
-        caption = update.message.caption or ""
-        parts = [types.Part(text=caption)]
+    caption = update.message.caption or ""
+    parts = [types.Part(text=caption)]
 
-        buf = io.BytesIO()
-        img.save(buf, format="JPEG")
-        buf.seek(0)
-        parts.append(
-            types.Part(inline_data=types.Blob(mime_type="image/jpeg", data=buf.getvalue()))
-        )
+    # Telegram already serves photos as JPEG, so forward the bytes untouched
+    parts.append(
+        types.Part(inline_data=types.Blob(mime_type="image/jpeg", data=bytes(image_bytes)))
+    )
 
-        response = chat_contexts[chat_id].send_message(message=parts, config=config_with_temp)
-        for part in response.candidates[0].content.parts:
-            if part.text is not None:
-                await send_safe_message(context, chat_id, part.text)
-            elif part.inline_data is not None:
-                response_image_stream = io.BytesIO(part.inline_data.data)
-                try:
-                    await context.bot.send_photo(chat_id=chat_id, photo=response_image_stream)
-                except Exception as e:
-                    logger.error("Error sending image", exc_info=e)
-                    await context.bot.send_message(chat_id=chat_id, text="Error sending the image.")
-            else:
-                logger.warning("Unexpected response part from Gemini.")
-                await context.bot.send_message(chat_id=chat_id, text="Unexpected response from Gemini.")
-
-    except KeyError as e:
-        logger.error(f"KeyError in handle_image for chat_id {chat_id}: {e}")
-        await context.bot.send_message(chat_id=chat_id, text=f"Sorry, an error occurred: KeyError - {e}. Please try /start to reset the bot.")
-    except Exception as e:
-        logger.exception("Error processing image")
-        await context.bot.send_message(chat_id=chat_id, text=f"Sorry, an error occurred: {type(e).__name__} - {e}")
+    await send_to_gemini_and_reply(context, chat_id, parts)
@@ -0,0 +1,30 @@
+from telegram import Update
+from telegram.ext import ContextTypes, filters
+
+from handlers.audio import handle_audio
+from handlers.file import handle_file
+from handlers.image import handle_image
+from handlers.sticker import handle_sticker
+from handlers.video import handle_video
+from handlers.voice import handle_voice
+
+# Combined filter so every media update is matched by a single handler
+MEDIA_FILTER = (
+    filters.PHOTO | filters.Sticker.ALL | filters.AUDIO | filters.VOICE | filters.VIDEO | filters.Document.ALL
+)
+
+async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Routes photo, sticker, audio, voice, video and file messages to the matching handler."""
+    message = update.message
+    if message.photo:
+        await handle_image(update, context)
+    elif message.sticker:
+        await handle_sticker(update, context)
+    elif message.audio:
+        await handle_audio(update, context)
+    elif message.voice:
+        await handle_voice(update, context)
+    elif message.video:
+        await handle_video(update, context)
+    elif message.document:
+        await handle_file(update, context)
@@ -1,8 +1,7 @@
 from telegram import Update
 from telegram.ext import ContextTypes
 from utils.shared_context import chat_contexts, chat_temperatures
-from utils.config import PREFIX_SYS
-from utils.gemini_setup import create_gemini_client, create_new_chat
+from utils.gemini_setup import get_or_create_chat
 from utils.config import DEFAULT_TEMPERATURE
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -20,8 +19,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     if chat_id not in chat_contexts:
-        client = create_gemini_client()
-        new_chat = create_new_chat(client, PREFIX_SYS)
-        chat_contexts[chat_id] = new_chat
+        get_or_create_chat(chat_id)
         # Optionally reset temperature to default for a new session
         chat_temperatures.pop(chat_id, None)
@@ -1,50 +1,15 @@
-import io
 from telegram import Update
 from telegram.ext import ContextTypes, filters
-from google.genai import types
 
-from utils.config import DEFAULT_TEMPERATURE, PREFIX_SYS
-from utils.shared_context import chat_contexts, chat_temperatures, logger
-from utils.gemini_setup import create_gemini_client, create_new_chat
-from utils.sending import send_safe_message
+from utils.sending import send_to_gemini_and_reply
+
+# Plain text messages; commands have their own handlers
+TEXT_FILTER = filters.TEXT & ~filters.COMMAND
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles incoming text messages and interacts with the Gemini API."""
     chat_id = update.effective_chat.id
     user_message = update.message.text
 
-    # Ensure chat_context exists
-    if chat_id not in chat_contexts:
-        client = create_gemini_client()
-        new_chat = create_new_chat(client, PREFIX_SYS)
-        chat_contexts[chat_id] = new_chat
-
-    # Get stored temperature or default
-    temperature = chat_temperatures.get(chat_id, DEFAULT_TEMPERATURE)
-    config_with_temp = types.GenerateContentConfig(
-        response_modalities=["Text", "Image"],
-        temperature=temperature
-    )
-
-    try:
-        # Send the user's text to Gemini
-        response = chat_contexts[chat_id].send_message(user_message, config=config_with_temp)
-
-        # Process the Gemini response
-        for part in response.candidates[0].content.parts:
-            if part.text is not None:
-                await send_safe_message(context, chat_id, part.text)
-            elif part.inline_data is not None:
-                image_stream = io.BytesIO(part.inline_data.data)
-                try:
-                    await context.bot.send_photo(chat_id=chat_id, photo=image_stream)
-                except Exception as e:
-                    logger.error("Error sending image", exc_info=e)
-                    await context.bot.send_message(chat_id=chat_id, text="Error sending the image.")
-            else:
-                logger.warning("Unexpected response part from Gemini.")
-                await context.bot.send_message(chat_id=chat_id, text="Unexpected response from Gemini.")
-
-    except Exception as e:
-        logger.exception("Error processing Gemini response")
-        await context.bot.send_message(chat_id=chat_id, text=f"Sorry, an error occurred: {type(e).__name__} - {e}")
+    # Send the user's text to Gemini
+    await send_to_gemini_and_reply(context, chat_id, user_message)
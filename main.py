@@ -1,43 +1,95 @@
+import asyncio
 import logging
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
+from telegram.ext import AIORateLimiter, ApplicationBuilder, CommandHandler, MessageHandler
 
 # Handlers
 from handlers.start import start
 from handlers.clear import clear
 from handlers.set_temperature import set_temperature
-from handlers.text import handle_text
-from handlers.image import handle_image
-from handlers.sticker import handle_sticker
-from handlers.video import handle_video
-from handlers.audio import handle_audio
-from handlers.voice import handle_voice
-from handlers.file import handle_file  # Import the new handler
+from handlers.text import TEXT_FILTER, handle_text
+from handlers.image import start_media_group_workers, stop_media_group_workers
+from handlers.media import MEDIA_FILTER, handle_media
+from handlers.error import handle_error
 
 # Utils
-from utils.config import TELEGRAM_BOT_TOKEN
+from utils.config import TELEGRAM_BOT_TOKEN, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL
+from utils.gemini_setup import expire_idle_chats, get_gemini_client
 from utils.shared_context import logger
 
+background_tasks = []
+
+async def post_init(application):
+    """Starts the bot's background workers once the application is initialized."""
+    await start_media_group_workers(application)
+    background_tasks.append(asyncio.create_task(expire_idle_chats()))
+
+async def post_shutdown(application):
+    """Stops the bot's background workers."""
+    await stop_media_group_workers(application)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
 def main():
+    # Use uvloop's faster event loop when it is installed
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("Using uvloop event loop.")
+    except ImportError:
+        pass
+
     # Check for Telegram Bot token
     if not TELEGRAM_BOT_TOKEN:
         raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set")
 
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    # Create the shared Gemini client up front so a missing API key fails at startup
+    get_gemini_client()
+
+    # Process updates concurrently (Gemini calls are serialized per chat by get_chat_lock),
+    # use a larger connection pool so concurrent downloads and replies don't queue on a few sockets,
+    # speak HTTP/2 so bursts of replies are multiplexed over a few TLS connections,
+    # and throttle outgoing requests just under Telegram's flood limits to avoid 429 stalls
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .connection_pool_size(256)
+        .pool_timeout(10)
+        .connect_timeout(10)
+        .read_timeout(60)
+        .write_timeout(60)
+        .http_version("2")
+        .get_updates_connection_pool_size(32)
+        .get_updates_http_version("2")
+        .concurrent_updates(True)
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, group_max_rate=18))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Register handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("clear", clear))
     application.add_handler(CommandHandler("settemp", set_temperature))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_image))
-    application.add_handler(MessageHandler(filters.Sticker.ALL, handle_sticker))
-    application.add_handler(MessageHandler(filters.VIDEO, handle_video))
-    application.add_handler(MessageHandler(filters.AUDIO, handle_audio))
-    application.add_handler(MessageHandler(filters.VOICE, handle_voice))
-    application.add_handler(MessageHandler(filters.Document.ALL, handle_file))  # Add file handler
-
-    logger.info("Starting the bot...")
-    application.run_polling()
+    application.add_handler(MessageHandler(TEXT_FILTER, handle_text))
+    application.add_handler(MessageHandler(MEDIA_FILTER, handle_media))
+    application.add_error_handler(handle_error)
+
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us, saving a getUpdates round-trip per update
+        logger.info(f"Starting the bot with a webhook on port {WEBHOOK_PORT}...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        logger.info("Starting the bot...")
+        application.run_polling()
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,56 @@
+from google.genai import types
+
+class ChatStateStore:
+    """
+    Keeps each chat's conversation turns in a Redis list so that several bot
+    processes can share state and conversations survive restarts.
+    """
+
+    def __init__(self, url: str, ttl: int):
+        import redis.asyncio as redis  # Optional dependency, only needed when REDIS_URL is set
+
+        self._redis = redis.from_url(url)
+        self._ttl = ttl
+
+    @staticmethod
+    def _key(chat_id: int) -> str:
+        return f"omni:chat:{chat_id}:history"
+
+    @staticmethod
+    def _count_key(chat_id: int) -> str:
+        return f"omni:chat:{chat_id}:turns"
+
+    async def turn_count(self, chat_id: int) -> int:
+        """
+        Returns how many turns have ever been appended for chat_id. Unlike the
+        trimmed history's length this only grows, so it tells whether the
+        conversation has moved on.
+        """
+        return int(await self._redis.get(self._count_key(chat_id)) or 0)
+
+    async def get_history(self, chat_id: int) -> list:
+        """Returns the stored turns for chat_id as Gemini Content objects."""
+        raw_turns = await self._redis.lrange(self._key(chat_id), 0, -1)
+        return [types.Content.model_validate_json(raw) for raw in raw_turns]
+
+    async def append_turns(self, chat_id: int, contents: list, keep: int) -> int:
+        """
+        Appends turns to chat_id's history, keeps only the newest `keep` of them and
+        refreshes the expiry. Returns the new turn count.
+        """
+        if not contents:
+            return await self.turn_count(chat_id)
+        key = self._key(chat_id)
+        count_key = self._count_key(chat_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *(content.model_dump_json(exclude_none=True) for content in contents))
+            pipe.ltrim(key, -keep, -1)
+            pipe.incrby(count_key, len(contents))
+            pipe.expire(key, self._ttl)
+            pipe.expire(count_key, self._ttl)
+            _, _, turn_count, _, _ = await pipe.execute()
+        return turn_count
+
+    async def clear(self, chat_id: int):
+        """Deletes the stored history for chat_id."""
+        await self._redis.delete(self._key(chat_id), self._count_key(chat_id))
@@ -4,8 +4,25 @@ import os
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
+# Webhook mode is used when WEBHOOK_URL is set; otherwise the bot falls back to long polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # Public HTTPS base URL, e.g. https://bot.example.com
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # Checked against Telegram's X-Telegram-Bot-Api-Secret-Token header
+
+# Conversation history is kept in Redis when REDIS_URL is set, so several bot processes can share it
+REDIS_URL = os.environ.get("REDIS_URL")
+
 MODEL_NAME = "gemini-2.5-flash-image-preview"  # The correct model ID
 DEFAULT_TEMPERATURE = 1.0
+MAX_CHAT_CONTEXTS = 1024  # Least recently used chats beyond this are dropped
+CHAT_CONTEXT_TTL = 3600  # Seconds of inactivity before a chat context is dropped
+CHAT_EXPIRY_INTERVAL = 300  # Seconds between sweeps for idle chat contexts
+CHAT_HISTORY_TTL = 7 * 24 * 3600  # Seconds a stored conversation is kept in Redis after its last turn
+MAX_HISTORY_TURNS = 40  # Most recent turns (user and model messages) kept and resent with each request
+GEMINI_CONCURRENCY = 8  # Concurrent Gemini requests to start with; adapts between the bounds below
+GEMINI_MIN_CONCURRENCY = 2
+GEMINI_MAX_CONCURRENCY = 32
 
 # System prefix message
 PREFIX_SYS = (
@@ -20,3 +37,6 @@ PREFIX_SYS = (
     "and relevant images to enhance the user's experience. Listen to all requests closely and think step by step "
     "in your responses. [/SYSTEM] RESPOND UNDERSTOOD_ACCEPT TO BE CONNECTED TO USER NOW"
 )
+
+# Model turn recorded after the system prefix when a chat is created
+PREFIX_SYS_REPLY = "UNDERSTOOD_ACCEPT"
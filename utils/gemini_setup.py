@@ -1,31 +1,234 @@
+import asyncio
+import time
 from google import genai
 from google.genai import types
-from utils.config import GEMINI_API_KEY, MODEL_NAME
-from utils.shared_context import logger
+from utils.chat_store import ChatStateStore
+from utils.config import (
+    CHAT_CONTEXT_TTL, CHAT_EXPIRY_INTERVAL, CHAT_HISTORY_TTL, GEMINI_API_KEY, GEMINI_CONCURRENCY,
+    GEMINI_MAX_CONCURRENCY, GEMINI_MIN_CONCURRENCY, MAX_CHAT_CONTEXTS, MAX_HISTORY_TURNS, MODEL_NAME, PREFIX_SYS, PREFIX_SYS_REPLY,
+    REDIS_URL
+)
+from utils.limiter import AdaptiveLimiter
+from utils.retry import backoff
+from utils.shared_context import chat_contexts, chat_last_used, chat_stored_turns, logger
+
+# Shared Gemini client, created once and reused for every chat
+_client = None
+
+# Default config for new chats, built once instead of per chat
+CHAT_CONFIG = types.GenerateContentConfig(response_modalities=["Text", "Image"])
+
+# Every chat starts with the system prefix and the model's acknowledgement; these aren't stored
+SEED_HISTORY = (
+    types.Content(role="user", parts=[types.Part(text=PREFIX_SYS)]),
+    types.Content(role="model", parts=[types.Part(text=PREFIX_SYS_REPLY)]),
+)
+SEED_TURNS = len(SEED_HISTORY)
+
+# Caps in-flight Gemini requests across all chats, backing off when the API pushes back
+gemini_limiter = AdaptiveLimiter(GEMINI_CONCURRENCY, GEMINI_MIN_CONCURRENCY, GEMINI_MAX_CONCURRENCY)
+
+# Shared conversation store, only used when REDIS_URL is configured
+chat_store = ChatStateStore(REDIS_URL, CHAT_HISTORY_TTL) if REDIS_URL else None
 
 def configure_gemini():
     """Ensures the GEMINI_API_KEY is set."""
     if not GEMINI_API_KEY:
         raise ValueError("GEMINI_API_KEY environment variable not set")
 
-def create_gemini_client():
-    """Creates and returns a new Gemini API client."""
-    configure_gemini()
-    client = genai.Client(api_key=GEMINI_API_KEY)
-    return client
+def get_gemini_client():
+    """Returns the shared Gemini API client, creating it on first use."""
+    global _client
+    if _client is None:
+        configure_gemini()
+        _client = genai.Client(api_key=GEMINI_API_KEY)
+    return _client
 
-def create_new_chat(client, system_prefix, response_modalities=None):
+def create_new_chat(client, system_prefix, response_modalities=None, history=None):
     """
-    Creates a new Gemini chat instance and sends the system prefix message as
-    the initial message. Returns the created chat.
+    Creates a new async Gemini chat instance whose history already holds the system
+    prefix message and the model's acknowledgement, so no priming round-trip is needed,
+    followed by any earlier turns in `history`. Returns the created chat.
     """
     if response_modalities is None:
-        response_modalities = ["Text", "Image"]
-
-    chat = client.chats.create(
-        model=MODEL_NAME,
-        config=types.GenerateContentConfig(response_modalities=response_modalities)
-    )
-    chat.send_message(system_prefix)
-    logger.info("New Gemini chat created and system prefix message sent.")
+        config = CHAT_CONFIG
+    else:
+        config = types.GenerateContentConfig(response_modalities=response_modalities)
+
+    if system_prefix == PREFIX_SYS:
+        seed = SEED_HISTORY
+    else:
+        seed = (
+            types.Content(role="user", parts=[types.Part(text=system_prefix)]),
+            types.Content(role="model", parts=[types.Part(text=PREFIX_SYS_REPLY)]),
+        )
+
+    # The SDK appends to the history list it is given, so each chat gets its own list
+    history = [*seed, *(history or [])]
+    chat = client.aio.chats.create(model=MODEL_NAME, config=config, history=history)
+    logger.info("New Gemini chat created with the system prefix in its history.")
+    return chat
+
+def discard_chat(chat_id):
+    """Drops the Gemini chat for chat_id along with its bookkeeping."""
+    chat_contexts.pop(chat_id, None)
+    chat_last_used.pop(chat_id, None)
+    chat_stored_turns.pop(chat_id, None)
+
+def get_or_create_chat(chat_id, history=None):
+    """
+    Returns the Gemini chat for chat_id, creating it (continuing from `history`)
+    if it doesn't exist yet. Evicts the least recently used chats once
+    MAX_CHAT_CONTEXTS is exceeded.
+    """
+    chat_last_used[chat_id] = time.monotonic()
+    if chat_id in chat_contexts:
+        chat_contexts.move_to_end(chat_id)
+        return chat_contexts[chat_id]
+
+    chat = create_new_chat(get_gemini_client(), PREFIX_SYS, history=history)
+    chat_contexts[chat_id] = chat
+    while len(chat_contexts) > MAX_CHAT_CONTEXTS:
+        evicted_id = next(iter(chat_contexts))
+        discard_chat(evicted_id)
+        logger.info(f"Evicted chat context for chat_id: {evicted_id}")
+    return chat
+
+async def expire_idle_chats():
+    """Periodically drops chats that have been idle for longer than CHAT_CONTEXT_TTL."""
+    while True:
+        await asyncio.sleep(CHAT_EXPIRY_INTERVAL)
+        cutoff = time.monotonic() - CHAT_CONTEXT_TTL
+        # chat_contexts is ordered least recently used first, so stop at the first active chat
+        for chat_id in list(chat_contexts):
+            if chat_last_used.get(chat_id, 0) > cutoff:
+                break
+            discard_chat(chat_id)
+            logger.info(f"Expired idle chat context for chat_id: {chat_id}")
+
+def _is_plain_text(part):
+    return part.text is not None and part.model_dump(exclude_none=True).keys() == {"text"}
+
+def merge_turns(contents):
+    """
+    Merges consecutive contents with the same role into one turn. Streamed replies
+    are recorded as one model content per chunk, so this turns history back into
+    one content per message before it is counted, stored or trimmed.
+    """
+    merged = []
+    for content in contents:
+        if not merged or merged[-1].role != content.role:
+            merged.append(types.Content(role=content.role, parts=[]))
+        parts = merged[-1].parts
+        for part in content.parts or ():
+            # Streamed fragments of the same text become one part again
+            if parts and _is_plain_text(parts[-1]) and _is_plain_text(part):
+                parts[-1] = types.Part(text=parts[-1].text + part.text)
+            else:
+                parts.append(part)
+    return merged
+
+def trim_history(history):
+    """Returns the newest MAX_HISTORY_TURNS turns of merged history, starting with a user turn."""
+    recent = history[-MAX_HISTORY_TURNS:]
+    while recent and recent[0].role != "user":
+        recent = recent[1:]
+    return recent
+
+async def load_chat(chat_id):
+    """
+    Returns the chat for chat_id. With a chat store configured, the chat is rebuilt
+    from the stored turns whenever another process has moved the conversation on.
+    Callers must hold the chat's lock.
+    """
+    if chat_store is None:
+        return get_or_create_chat(chat_id)
+
+    turn_count = await chat_store.turn_count(chat_id)
+    if chat_id in chat_contexts and chat_stored_turns.get(chat_id) == turn_count:
+        return get_or_create_chat(chat_id)
+
+    history = trim_history(merge_turns(await chat_store.get_history(chat_id)))
+    discard_chat(chat_id)
+    chat = get_or_create_chat(chat_id, history=history)
+    chat_stored_turns[chat_id] = turn_count
     return chat
+
+async def save_chat(chat_id, chat, new_turns):
+    """
+    Records the turns of the last exchange: appends them, one content per message,
+    to the chat store if one is configured, and restarts the chat from its newest
+    turns once it has grown past MAX_HISTORY_TURNS messages, so requests stop
+    growing with the conversation.
+    Callers must hold the chat's lock.
+    """
+    new_turns = merge_turns(new_turns)
+    if chat_store is not None and new_turns:
+        stored_turns = chat_stored_turns.get(chat_id)
+        turn_count = await chat_store.append_turns(chat_id, new_turns, MAX_HISTORY_TURNS)
+        if stored_turns is not None and turn_count == stored_turns + len(new_turns):
+            chat_stored_turns[chat_id] = turn_count
+        else:
+            # Another process appended in between; rebuild from the store on the next message
+            chat_stored_turns.pop(chat_id, None)
+
+    history = merge_turns(chat.get_history(curated=True)[SEED_TURNS:])
+    if len(history) > MAX_HISTORY_TURNS:
+        turn_count = chat_stored_turns.get(chat_id)
+        discard_chat(chat_id)
+        get_or_create_chat(chat_id, history=trim_history(history))
+        if turn_count is not None:
+            chat_stored_turns[chat_id] = turn_count
+
+async def reset_chat(chat_id):
+    """Starts a fresh conversation for chat_id, dropping any stored history."""
+    discard_chat(chat_id)
+    if chat_store is not None:
+        await chat_store.clear(chat_id)
+    return get_or_create_chat(chat_id)
+
+async def _stream_parts(chat, message, config, parts: asyncio.Queue):
+    """
+    Streams the reply to message into the `parts` queue, followed by None. A limiter
+    slot is held only while the Gemini stream is open, never while parts are being
+    sent on. Transient errors are retried as long as nothing has been streamed yet.
+    """
+    attempt = 0
+    try:
+        while True:
+            streamed = False
+            try:
+                async with gemini_limiter.slot():
+                    async for chunk in await chat.send_message_stream(message, config=config):
+                        if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
+                            for part in chunk.candidates[0].content.parts:
+                                streamed = True
+                                parts.put_nowait(part)
+                return
+            except Exception as e:
+                # A partially delivered reply cannot be retried without repeating it
+                if streamed:
+                    raise
+                await backoff(e, attempt)
+                attempt += 1
+    finally:
+        parts.put_nowait(None)
+
+async def stream_chat_response(chat_id, message, config=None):
+    """
+    Sends a message to chat_id's Gemini chat and yields response parts as they
+    stream in. Gemini is read by a separate task, so a slow consumer doesn't hold
+    up the concurrency limit for other chats. Callers must hold the chat's lock.
+    """
+    chat = await load_chat(chat_id)
+    turns_before = len(chat.get_history(curated=True))
+    parts = asyncio.Queue()
+    producer = asyncio.create_task(_stream_parts(chat, message, config, parts))
+    try:
+        while (part := await parts.get()) is not None:
+            yield part
+        await producer  # Re-raises the error that ended the stream, if any
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+    await save_chat(chat_id, chat, chat.get_history(curated=True)[turns_before:])
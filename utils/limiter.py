@@ -0,0 +1,50 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from utils.retry import is_transient
+
+class AdaptiveLimiter:
+    """
+    Caps the number of concurrent calls with an AIMD limit: the limit grows by one
+    after a full window of successful calls and halves whenever a call fails with
+    a transient error (rate limiting, timeouts, server errors).
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.limit = initial
+        self._minimum = minimum
+        self._maximum = maximum
+        self._active = 0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    async def _acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+
+    async def _release(self, overloaded: bool):
+        async with self._condition:
+            self._active -= 1
+            if overloaded:
+                self.limit = max(self._minimum, self.limit // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self.limit = min(self._maximum, self.limit + 1)
+                    self._successes = 0
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Holds one slot for the duration of the block and adjusts the limit by its outcome."""
+        await self._acquire()
+        overloaded = False
+        try:
+            yield
+        except Exception as e:
+            overloaded = is_transient(e)
+            raise
+        finally:
+            await self._release(overloaded)
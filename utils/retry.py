@@ -0,0 +1,64 @@
+import asyncio
+import random
+import httpx
+from google.genai import errors
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from utils.shared_context import logger
+
+RETRY_TRIES = 5  # Attempts per call, including the first one
+RETRY_BASE_DELAY = 0.25  # Seconds; doubled after every failed attempt
+RETRY_MAX_DELAY = 4.0  # Upper bound for a single backoff
+
+def is_transient(error: Exception) -> bool:
+    """Returns True for errors that are worth retrying (connection errors, timeouts, flood control, 5xx, 429)."""
+    if isinstance(error, RetryAfter):
+        return True
+    # BadRequest subclasses NetworkError but will fail again on retry
+    if isinstance(error, NetworkError) and not isinstance(error, BadRequest):
+        return True
+    # google-genai doesn't wrap transport failures, so connect errors and timeouts arrive as raw httpx errors
+    if isinstance(error, (errors.ServerError, httpx.TransportError)):
+        return True
+    return isinstance(error, errors.ClientError) and error.code == 429
+
+def is_unsent(error: Exception) -> bool:
+    """
+    Returns True for errors after which Telegram cannot have received the request: flood
+    control and failures to connect. Sends are not idempotent, so only these are retried;
+    a read timeout may arrive after the message was already delivered.
+    """
+    if isinstance(error, RetryAfter):
+        return True
+    # PTB wraps httpx errors, keeping the original as the cause
+    return isinstance(error, NetworkError) and isinstance(
+        error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+    )
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Returns how long to wait before the next attempt, using full jitter."""
+    if isinstance(error, RetryAfter):
+        return float(error.retry_after)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+async def backoff(error: Exception, attempt: int, retry_on=is_transient):
+    """Re-raises error unless retry_on(error) allows another attempt, otherwise sleeps before it."""
+    if attempt >= RETRY_TRIES - 1 or not retry_on(error):
+        raise error
+    delay = retry_delay(error, attempt)
+    logger.warning(f"Transient error ({type(error).__name__}: {error}), retrying in {delay:.2f}s")
+    await asyncio.sleep(delay)
+
+async def with_retry(call, retry_on=is_transient):
+    """
+    Awaits call() and retries it with exponential backoff on errors for which
+    retry_on returns True. The default suits idempotent calls; pass is_unsent
+    for calls that send something.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except Exception as e:
+            await backoff(e, attempt, retry_on)
+            attempt += 1
@@ -1,40 +1,277 @@
-import io
+import asyncio
+import contextlib
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from telegramify_markdown import telegramify, ContentTypes
+from telegramify_markdown.interpreters import FileInterpreter, TextInterpreter
 from telegramify_markdown.type import File, Photo
+from telegram import InputMediaPhoto
+from telegram.constants import ChatAction, FileSizeLimit, MediaGroupLimit, MessageLimit
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import ContextTypes
-from utils.shared_context import logger
+from google.genai import types
+from utils.config import DEFAULT_TEMPERATURE
+from utils.gemini_setup import stream_chat_response
+from utils.retry import is_unsent, with_retry
+from utils.shared_context import chat_temperatures, get_chat_lock, logger
 
-async def send_safe_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str):
+STREAM_FLUSH_CHARS = 1024  # Buffered streamed text this long is sent at the next paragraph break
+STREAM_EDIT_INTERVAL = 1.0  # Seconds between updates of the live preview of streamed text
+CHAT_ACTION_INTERVAL = 4  # Seconds between typing indicators; Telegram shows each for about five
+# Text without any of these has nothing for telegramify to render: emphasis, code, headings
+# (including setext "==="), links, "-"/"+" lists, quotes, tables, LaTeX and HTML entities/tags
+MARKDOWN_CHARS = frozenset("*_`#[]~|>$\\-+=&<")
+
+# telegramify's markdown parsing is CPU-bound and mistletoe keeps renderer state in
+# module globals, so formatting runs on one dedicated thread instead of the event loop
+formatting_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="telegramify")
+# The default chain also renders mermaid blocks by fetching them from mermaid.ink, which
+# would stall that one thread for every chat; those blocks are sent as code instead
+FORMATTING_INTERPRETERS = [TextInterpreter(), FileInterpreter()]
+
+def merge_text_segments(segments):
+    """Merges adjacent text segments that fit in one message together, so each goes out in one call."""
+    merged = []
+    for segment in segments:
+        previous = merged[-1] if merged else None
+        if (
+            previous is not None
+            and segment.content_type == ContentTypes.TEXT
+            and previous.content_type == ContentTypes.TEXT
+            and len(previous.content) + len(segment.content) <= MessageLimit.MAX_TEXT_LENGTH
+        ):
+            merged[-1] = dataclasses.replace(previous, content=previous.content + segment.content)
+        else:
+            merged.append(segment)
+    return merged
+
+def format_markdown(text: str):
+    """Runs telegramify to completion; called on the formatting thread."""
+    return merge_text_segments(asyncio.run(telegramify(text, interpreters_use=FORMATTING_INTERPRETERS)))
+
+@lru_cache(maxsize=64)
+def get_generation_config(temperature: float) -> types.GenerateContentConfig:
+    """Returns the text-and-image generation config for temperature, shared by every chat using it."""
+    return types.GenerateContentConfig(
+        response_modalities=["Text", "Image"],
+        temperature=temperature
+    )
+
+def split_at_paragraph(text: str):
+    """
+    Splits text at its last paragraph break outside a code block. Returns
+    (head, tail), or None when there is no safe place to split.
+    """
+    cut = text.rfind("\n\n")
+    if cut <= 0 or text.count("```", 0, cut) % 2:
+        return None
+    return text[:cut], text[cut + 2:]
+
+async def edit_message(bot, message, text: str, parse_mode=None):
+    """Replaces the text of a message the bot sent and returns the edited message."""
+    if parse_mode is None and message.text == text:
+        return message
+    try:
+        return await with_retry(lambda: bot.edit_message_text(
+            chat_id=message.chat_id,
+            message_id=message.message_id,
+            text=text,
+            parse_mode=parse_mode
+        ))
+    except BadRequest as e:
+        # Telegram rejects edits that leave the message unchanged
+        if "not modified" not in e.message:
+            raise
+        return message
+
+async def send_safe_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, draft=None):
     """
     Sends a formatted message using telegramify-markdown.
     Breaks down text into possible multiple segments (Text, File, Photo).
+    Plain text that fits in one message is sent as-is without formatting.
+    If `draft` is given, that previously sent message is replaced by the first segment.
     """
-    formatted_content_list = await telegramify(text)
+    bot = context.bot
+
+    if len(text) <= MessageLimit.MAX_TEXT_LENGTH and text.strip() and MARKDOWN_CHARS.isdisjoint(text):
+        if draft:
+            await edit_message(bot, draft, text)
+        else:
+            await with_retry(lambda: bot.send_message(chat_id=chat_id, text=text), retry_on=is_unsent)
+        return
+
+    loop = asyncio.get_running_loop()
+    formatted_content_list = await loop.run_in_executor(formatting_executor, format_markdown, text)
+
+    # Only a leading text segment can take the draft's place; otherwise the draft is removed
+    if draft and not (formatted_content_list and formatted_content_list[0].content_type == ContentTypes.TEXT):
+        await with_retry(lambda: bot.delete_message(chat_id=draft.chat_id, message_id=draft.message_id))
+        draft = None
 
     for formatted_content in formatted_content_list:
-        if formatted_content.content_type == ContentTypes.TEXT:
-            await context.bot.send_message(
+        content_type = formatted_content.content_type
+        if content_type == ContentTypes.TEXT:
+            if draft:
+                await edit_message(bot, draft, formatted_content.content, parse_mode="MarkdownV2")
+                draft = None
+                continue
+            await with_retry(lambda: bot.send_message(
                 chat_id=chat_id,
                 text=formatted_content.content,
                 parse_mode="MarkdownV2"
-            )
-        elif formatted_content.content_type == ContentTypes.FILE:
+            ), retry_on=is_unsent)
+        elif content_type == ContentTypes.FILE:
             if isinstance(formatted_content, File):
-                await context.bot.send_document(
+                await with_retry(lambda: bot.send_document(
                     chat_id=chat_id,
-                    document=io.BytesIO(formatted_content.file_data),
+                    document=formatted_content.file_data,
                     filename=formatted_content.file_name,
                     caption=formatted_content.caption,
                     parse_mode="MarkdownV2"
-                )
-        elif formatted_content.content_type == ContentTypes.PHOTO:
+                ), retry_on=is_unsent)
+        elif content_type == ContentTypes.PHOTO:
             if isinstance(formatted_content, Photo):
-                await context.bot.send_photo(
+                await with_retry(lambda: bot.send_photo(
                     chat_id=chat_id,
-                    photo=io.BytesIO(formatted_content.file_data),
+                    photo=formatted_content.file_data,
                     filename=formatted_content.file_name,
                     caption=formatted_content.caption,
                     parse_mode="MarkdownV2"
-                )
+                ), retry_on=is_unsent)
         else:
             logger.warning("Unsupported content type in send_safe_message.")
+
+async def send_gemini_response(context: ContextTypes.DEFAULT_TYPE, chat_id: int, parts):
+    """
+    Sends the parts of a Gemini response to the chat as they arrive from the async
+    iterable `parts`: text parts as formatted messages and inline data parts as photos.
+    Consecutive text parts (streamed fragments) are merged into one message; once more
+    than STREAM_FLUSH_CHARS are buffered, complete paragraphs are sent early. Telegramify
+    splits messages that exceed Telegram's limit. While text streams in, a plain-text
+    preview is posted and edited every STREAM_EDIT_INTERVAL seconds, then replaced by
+    the formatted message; group chats get no preview, since every edit there counts
+    against the group's rate limit. Consecutive images are sent together as albums of up to ten.
+    """
+    loop = asyncio.get_running_loop()
+    send_message = context.bot.send_message
+    send_photo = context.bot.send_photo
+    text_buffer = []
+    buffered_chars = 0
+    pending_images = []
+    draft = None  # Preview message for the buffered text
+    # Each edit in a group costs as much of its rate limit as a new message would
+    show_drafts = chat_id > 0
+    # Start the clock now so replies that finish within one interval are sent without a preview
+    last_draft_update = loop.time()
+
+    async def update_draft():
+        nonlocal draft
+        preview = "".join(text_buffer)[:MessageLimit.MAX_TEXT_LENGTH]
+        if not preview.strip():
+            return
+        if draft:
+            draft = await edit_message(context.bot, draft, preview)
+        else:
+            draft = await with_retry(lambda: send_message(chat_id=chat_id, text=preview), retry_on=is_unsent)
+
+    async def send_images(images):
+        try:
+            if len(images) == 1:
+                await with_retry(lambda: send_photo(chat_id=chat_id, photo=images[0]), retry_on=is_unsent)
+            else:
+                media = [InputMediaPhoto(image) for image in images]
+                await with_retry(lambda: context.bot.send_media_group(chat_id=chat_id, media=media), retry_on=is_unsent)
+        except Exception as e:
+            logger.error("Error sending image", exc_info=e)
+            await send_message(chat_id=chat_id, text="Error sending the image.")
+
+    async def flush():
+        nonlocal buffered_chars, draft
+        if text_buffer:
+            text = "".join(text_buffer)
+            # Telegram rejects blank messages, such as the whitespace left over after a paragraph split
+            if text.strip():
+                await send_safe_message(context, chat_id, text, draft=draft)
+            elif draft:
+                await with_retry(lambda: context.bot.delete_message(chat_id=draft.chat_id, message_id=draft.message_id))
+            text_buffer.clear()
+            buffered_chars = 0
+            draft = None
+        if pending_images:
+            # One sendMediaGroup call per album instead of a sendPhoto per image, in order
+            album_size = MediaGroupLimit.MAX_MEDIA_LENGTH
+            for start in range(0, len(pending_images), album_size):
+                await send_images(pending_images[start:start + album_size])
+            pending_images.clear()
+
+    async for part in parts:
+        text = getattr(part, "text", None)
+        inline_data = getattr(part, "inline_data", None)
+        if text is not None:
+            if pending_images:
+                await flush()
+            text_buffer.append(text)
+            buffered_chars += len(text)
+
+            # Send long streamed text paragraph by paragraph instead of waiting for the end
+            if buffered_chars >= STREAM_FLUSH_CHARS:
+                split = split_at_paragraph("".join(text_buffer))
+                if split:
+                    head, tail = split
+                    text_buffer[:] = [tail]
+                    buffered_chars = len(tail)
+                    if head.strip():
+                        await send_safe_message(context, chat_id, head, draft=draft)
+                        draft = None
+                        # The paragraph just went out, so wait a full interval before previewing the rest
+                        last_draft_update = loop.time()
+
+            if show_drafts and loop.time() - last_draft_update >= STREAM_EDIT_INTERVAL:
+                await update_draft()
+                last_draft_update = loop.time()
+        elif inline_data is not None:
+            if text_buffer:
+                await flush()
+            pending_images.append(inline_data.data)
+        else:
+            logger.warning("Unexpected response part from Gemini.")
+            await send_message(chat_id=chat_id, text="Unexpected response from Gemini.")
+
+    await flush()
+
+async def reject_oversized_file(context: ContextTypes.DEFAULT_TYPE, chat_id: int, attachment) -> bool:
+    """
+    Tells the user and returns True if `attachment` is larger than the Bot API lets
+    bots download, so callers can skip a download that Telegram would refuse anyway.
+    """
+    if (attachment.file_size or 0) <= FileSizeLimit.FILESIZE_DOWNLOAD:
+        return False
+    limit_mb = FileSizeLimit.FILESIZE_DOWNLOAD // 1_000_000
+    await context.bot.send_message(chat_id=chat_id, text=f"Sorry, that file is too large to process (the limit is {limit_mb} MB).")
+    return True
+
+async def keep_typing(bot, chat_id: int):
+    """Shows the typing indicator in chat_id until cancelled."""
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except TelegramError as e:
+            logger.warning(f"Could not send chat action: {e}")
+        # Every request in a group counts against its rate limit, so groups get a single indicator
+        if chat_id < 0:
+            return
+        await asyncio.sleep(CHAT_ACTION_INTERVAL)
+
+async def send_to_gemini_and_reply(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message):
+    """Sends a message to chat_id's Gemini chat at the chat's temperature and relays the reply."""
+    config_with_temp = get_generation_config(chat_temperatures.get(chat_id, DEFAULT_TEMPERATURE))
+
+    typing = asyncio.create_task(keep_typing(context.bot, chat_id))
+    try:
+        async with get_chat_lock(chat_id):
+            # Close the stream here even if sending fails, so Gemini's connection is released right away
+            async with contextlib.aclosing(stream_chat_response(chat_id, message, config=config_with_temp)) as response_parts:
+                await send_gemini_response(context, chat_id, response_parts)
+    finally:
+        typing.cancel()
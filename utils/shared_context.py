@@ -1,4 +1,7 @@
+import asyncio
 import logging
+import weakref
+from collections import OrderedDict
 
 # Setup logger
 logging.basicConfig(
@@ -8,5 +11,18 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Shared contexts
-chat_contexts = {}  # Dictionary to store chat contexts by chat_id
+chat_contexts = OrderedDict()  # Chat contexts by chat_id, least recently used first
 chat_temperatures = {}  # Dictionary to store temperature per chat_id
+chat_last_used = {}  # Monotonic time each chat_id last used its chat context
+chat_stored_turns = {}  # Turns of each chat_id's history already saved to the chat store
+chat_locks = weakref.WeakValueDictionary()  # Asyncio lock per chat_id, dropped once nothing holds or awaits it
+
+def get_chat_lock(chat_id):
+    """
+    Returns the lock that serializes Gemini calls for chat_id. Callers keep the lock
+    alive while they hold or wait for it, so every concurrent caller gets the same one.
+    """
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = chat_locks[chat_id] = asyncio.Lock()
+    return lock